@@ -15,6 +15,7 @@ setup(
         "ciso8601==2.1.3",
         "idna==2.10",
         "jsonschema==2.6.0",
+        "orjson==3.8.3",
         "python-dateutil==2.8.1",
         "pytz==2018.4",
         "requests==2.25.1",
@@ -23,6 +24,10 @@ setup(
         "six==1.15.0",
         "urllib3==1.26.18",
     ],
+    extras_require={
+        # lets urllib3 negotiate and decode brotli compressed responses
+        "brotli": ["brotli==1.0.9"],
+    },
     entry_points="""
     [console_scripts]
     tap-ms-dynamics=tap_dynamics:main
@@ -1,8 +1,9 @@
-import singer
+import singer.messages
 from singer import utils
 
 from tap_dynamics.discover import discover
-from tap_dynamics.sync import sync
+from tap_dynamics.logger import LOGGER
+from tap_dynamics.sync import sync, write_message
 
 REQUIRED_CONFIG_KEYS = [
     "start_date",
@@ -13,7 +14,6 @@ REQUIRED_CONFIG_KEYS = [
     "redirect_uri",
     "refresh_token"
 ]
-LOGGER = singer.get_logger()
 
 
 @utils.handle_top_exception(LOGGER)
@@ -21,6 +21,11 @@ def main():
     # Parse command line arguments
     args = utils.parse_args(REQUIRED_CONFIG_KEYS)
 
+    # the tap owns the process, so swap singer's message writer for one that
+    # encodes records with orjson and doesn't flush every RECORD here, once,
+    # rather than from library code
+    singer.messages.write_message = write_message
+
     # If discover flag was passed, run discovery mode and dump output to stdout
     if args.discover:
         catalog = discover(args.config, args.config_path)
@@ -1,39 +1,93 @@
 import os
 import sys
-import math
-import json
-from datetime import datetime, timedelta
+import logging
+import random
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
 
 import backoff
+import orjson
 import requests
 import singer
-from simplejson import JSONDecodeError
+from requests.adapters import HTTPAdapter
+from urllib3.util.request import ACCEPT_ENCODING
 
+from tap_dynamics.logger import LOGGER
 from tap_dynamics.transform import transform_metadata_xml
 
-
-LOGGER = singer.get_logger()
+_MODULE_DIR = os.path.dirname(os.path.realpath(__file__))
 
 API_VERSION = '9.2'
 MAX_PAGESIZE = 5000
 MAX_RETRIES = 5
+MAX_BACKOFF_SECONDS = 60
+POOL_CONNECTIONS = 4
+POOL_MAXSIZE = 32
+# $select is repeated in every @odata.nextLink, past this many characters it
+# is dropped so wide tables stay under the Web API URL length limit
+MAX_SELECT_LENGTH = 4096
+METADATA_CACHE_FILENAME = '.dynamics_metadata_cache.json'
+TOKEN_CACHE_FILENAME = '.dynamics_token_cache.json'
+
+# sent with every Web API request, but not to the token endpoint
+ODATA_HEADERS = {
+    "OData-MaxVersion": "4.0",
+    "OData-Version": "4.0",
+    # Dataverse only issues ETags per record (`@odata.etag`), not for
+    # collection pages, so conditional GETs can't skip unchanged pages;
+    # "null" makes sure cached results are never served
+    "If-None-Match": "null",
+}
+# bump when the output of transform_metadata_xml changes shape
+METADATA_CACHE_VERSION = 1
 
 def get_abs_path(path):
-    return os.path.join(os.path.dirname(os.path.realpath(__file__)), path)
+    return os.path.join(_MODULE_DIR, path)
+
+def write_file_atomic(path, data, mode=None):
+    """
+    Replaces the file at `path` with `data` through a temp file in the same
+    directory, so a crash mid-write can't truncate it. The file gets `mode`,
+    or keeps the permissions of the existing file, the config holds the
+    client secret and tokens. New files are only readable by the owner.
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)),
+                                    prefix=os.path.basename(path) + '.',
+                                    suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as file:
+            file.write(data)
+        if mode is None and os.path.exists(path):
+            mode = os.stat(path).st_mode & 0o7777
+        if mode is not None:
+            os.chmod(tmp_path, mode)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
 
 def log_backoff_attempt(details):
     LOGGER.info("ConnectionError detected, triggering backoff: %d try", details.get("tries"))
 
-def retry_after_wait_gen():
+def retry_after_wait_gen(base=2, max_value=MAX_BACKOFF_SECONDS):
+    attempt = 0
     while True:
         # This is called in an except block so we can retrieve the exception
         # and check it.
         exc_info = sys.exc_info()
-        resp = exc_info[1].response
-        sleep_time_str = resp.headers.get('Retry-After')
-        LOGGER.info(f'API rate limit exceeded -- sleeping for '
-                    f'{sleep_time_str} seconds')
-        yield math.floor(float(sleep_time_str))
+        retry_after = exc_info[1].retry_after
+        if retry_after is not None:
+            LOGGER.info(f'API rate limit exceeded -- sleeping for '
+                        f'{retry_after} seconds')
+            yield retry_after
+        else:
+            # no Retry-After header, fall back to capped exponential with jitter
+            yield min(base ** attempt + random.uniform(0, 1), max_value)
+        attempt += 1
 
 # pylint: disable=missing-class-docstring
 class DynamicsException(Exception):
@@ -58,6 +112,9 @@ class Dynamics429Exception(DynamicsException):
         self.message = message
         self.response = response
 
+        retry_after = response.headers.get('Retry-After') if response is not None else None
+        self.retry_after = int(float(retry_after)) if retry_after else None
+
 # pylint: disable=too-many-instance-attributes
 class DynamicsClient:
     def __init__(self,
@@ -73,6 +130,7 @@ class DynamicsClient:
                 start_date=None):
         self.organization_uri = organization_uri
         self.api_version = api_version if api_version else API_VERSION
+        self.api_base_url = f'{organization_uri.rstrip("/")}/api/data/v{self.api_version}/'
         max_pagesize = MAX_PAGESIZE if max_pagesize is None else max_pagesize # tap-tester was failing otherwise
         self.max_pagesize = max_pagesize if max_pagesize <= MAX_PAGESIZE else MAX_PAGESIZE
         self.client_id = client_id
@@ -82,27 +140,165 @@ class DynamicsClient:
         self.refresh_token = refresh_token
 
         self.session = requests.Session()
+        # retries are handled by the backoff decorators on `_make_request`
+        adapter = HTTPAdapter(pool_connections=POOL_CONNECTIONS,
+                              pool_maxsize=POOL_MAXSIZE,
+                              max_retries=0)
+        self.session.mount('https://', adapter)
+        self.session.headers.update({
+            "User-Agent": self.user_agent,
+            # "gzip,deflate" plus "br" when brotli is installed to decode it
+            "Accept-Encoding": ACCEPT_ENCODING,
+            })
+
         self.access_token = None
+        # time.monotonic() deadline, immune to wall clock jumps
         self.expires_at = None
+        self._token_lock = threading.Lock()
 
         self.start_date = start_date
         self.config_path = config_path
+        config_dir = os.path.dirname(os.path.abspath(config_path)) if config_path else None
+        # parsed `$metadata` is cached next to the config, keyed by its ETag
+        self.metadata_cache_path = os.path.join(
+            config_dir, METADATA_CACHE_FILENAME) if config_dir else None
+        # the access token is cached next to the config, readable by the owner only
+        self.token_cache_path = os.path.join(
+            config_dir, TOKEN_CACHE_FILENAME) if config_dir else None
+
+        # reuse the access token cached by a previous run while it is valid
+        token_cache = self._read_token_cache()
+        if token_cache:
+            expires_in = (singer.utils.strptime_to_utc(token_cache['expires_at'])
+                          - singer.utils.now()).total_seconds()
+            if expires_in > 0:
+                self._set_access_token(token_cache['access_token'], expires_in)
 
     def _write_config(self, refresh_token):
         LOGGER.info("Credentials Refreshed")
         self.refresh_token = refresh_token
 
+        if not self.config_path:
+            return
+
         # Update config at config_path
-        with open(self.config_path) as file:
-            config = json.load(file)
+        with open(self.config_path, 'rb') as file:
+            config = orjson.loads(file.read())
+
+        if config.get('refresh_token') == refresh_token:
+            return
 
         config['refresh_token'] = refresh_token
 
-        with open(self.config_path, 'w') as file:
-            json.dump(config, file, indent=2)
+        write_file_atomic(self.config_path, orjson.dumps(config, option=orjson.OPT_INDENT_2))
+
+    def _read_token_cache(self):
+        if not self.token_cache_path or not os.path.exists(self.token_cache_path):
+            return None
+
+        try:
+            with open(self.token_cache_path, 'rb') as file:
+                cache = orjson.loads(file.read())
+        except (OSError, orjson.JSONDecodeError) as ex:
+            LOGGER.warning('Ignoring unreadable token cache %s: %s', self.token_cache_path, ex)
+            return None
+
+        # a token is only valid for the org and app it was issued to
+        if not isinstance(cache, dict) \
+                or cache.get('organization_uri') != self.organization_uri \
+                or cache.get('client_id') != self.client_id \
+                or not cache.get('access_token') \
+                or not cache.get('expires_at'):
+            return None
+
+        return cache
+
+    def _write_token_cache(self, access_token, expires_at):
+        if not self.token_cache_path:
+            return
+
+        cache = {
+            'organization_uri': self.organization_uri,
+            'client_id': self.client_id,
+            'access_token': access_token,
+            'expires_at': expires_at,
+        }
+
+        try:
+            write_file_atomic(self.token_cache_path, orjson.dumps(cache), mode=0o600)
+        except OSError as ex:
+            LOGGER.warning('Unable to write token cache %s: %s', self.token_cache_path, ex)
+
+    def _read_metadata_cache(self):
+        if not self.metadata_cache_path or not os.path.exists(self.metadata_cache_path):
+            return None
+
+        # the cache is only an optimization, a bad one means a full download
+        try:
+            with open(self.metadata_cache_path, 'rb') as file:
+                cache = orjson.loads(file.read())
+        except (OSError, orjson.JSONDecodeError) as ex:
+            LOGGER.warning('Ignoring unreadable $metadata cache %s: %s', self.metadata_cache_path, ex)
+            return None
+
+        # the cached entities are only valid for the same cache format, org
+        # and api version
+        if not isinstance(cache, dict) \
+                or cache.get('version') != METADATA_CACHE_VERSION \
+                or cache.get('organization_uri') != self.organization_uri \
+                or cache.get('api_version') != self.api_version:
+            return None
+
+        return cache
+
+    def _write_metadata_cache(self, etag, entity_metadata):
+        cache = {
+            'version': METADATA_CACHE_VERSION,
+            'organization_uri': self.organization_uri,
+            'api_version': self.api_version,
+            'etag': etag,
+            'metadata': entity_metadata,
+        }
+
+        try:
+            write_file_atomic(self.metadata_cache_path, orjson.dumps(cache))
+        except OSError as ex:
+            LOGGER.warning('Unable to write $metadata cache %s: %s', self.metadata_cache_path, ex)
+
+    def _set_access_token(self, access_token, expires_in):
+        # deadline first, readers outside the lock check the token first
+        self.expires_at = time.monotonic() + expires_in
+        self.access_token = access_token
+
+    def _get_valid_access_token(self):
+        # read once, another thread may clear it concurrently
+        access_token = self.access_token
+        if access_token is None or self.expires_at <= time.monotonic():
+            return None
+        return access_token
+
+    def _invalidate_access_token(self, access_token):
+        # only clear the rejected token, another thread may already have
+        # replaced it and a second refresh would rotate the refresh_token again
+        with self._token_lock:
+            if self.access_token == access_token:
+                self.access_token = None
 
     def _ensure_access_token(self):
-        if self.access_token is None or self.expires_at <= datetime.utcnow():
+        """
+        Returns a valid access token, refreshing it when it has expired.
+        """
+        access_token = self._get_valid_access_token()
+        if access_token:
+            return access_token
+
+        # only one caller refreshes; the rest wait and reuse its token since
+        # every refresh invalidates the previous refresh_token
+        with self._token_lock:
+            access_token = self._get_valid_access_token()
+            if access_token:
+                return access_token
+
             response = self.session.post(
                 'https://login.microsoftonline.com/common/oauth2/token',
                 data={
@@ -119,55 +315,56 @@ class DynamicsClient:
 
             data = response.json()
 
-            self.access_token = data.get('access_token')
+            # pad by 10 seconds for clock drift
+            expires_in = int(data.get('expires_in')) - 10
+            expires_at = singer.utils.now() + timedelta(seconds=expires_in)
+
             if self.refresh_token != data.get('refresh_token'):
                 self._write_config(data.get('refresh_token'))
+            # cached so the next run can skip the token request
+            self._write_token_cache(data.get('access_token'), expires_at.isoformat())
 
-            # pad by 10 seconds for clock drift
-            self.expires_at = datetime.utcnow() + \
-                timedelta(seconds=int(data.get('expires_in')) - 10)
-
-    def _get_standard_headers(self):
-        return {
-            "Authorization": "Bearer {}".format(self.access_token),
-            "User-Agent": self.user_agent,
-            "OData-MaxVersion": "4.0",
-            "OData-Version": "4.0",
-            "If-None-Match": "null"
-            }
+            self._set_access_token(data.get('access_token'), expires_in)
+            return self.access_token
 
     @backoff.on_exception(retry_after_wait_gen,
                           Dynamics429Exception,
                           max_tries=MAX_RETRIES,
+                          jitter=None,
                           on_backoff=log_backoff_attempt)
+    # other 4xx responses are unrecoverable and fail immediately
     @backoff.on_exception(backoff.expo,
-                          (Dynamics5xxException, Dynamics4xxException, requests.ConnectionError),
+                          (Dynamics5xxException, requests.ConnectionError),
                           max_tries=MAX_RETRIES,
                           factor=2,
+                          max_value=MAX_BACKOFF_SECONDS,
+                          jitter=backoff.full_jitter,
                           on_backoff=log_backoff_attempt)
-    def _make_request(self, method, endpoint, paging=False, headers=None, params=None, data=None):
-        if not paging:
-            full_url = f'{self.organization_uri}/api/data/v{self.api_version}/{endpoint}'
-        else: full_url = endpoint
-
-        LOGGER.info(
-            "%s - Making request to %s endpoint %s, with params %s",
-            full_url,
-            method.upper(),
-            endpoint if not paging else '@odata.nextLink',
-            params,
-        )
-
-        self._ensure_access_token()
-
-        default_headers = self._get_standard_headers()
-
-        if headers:
-            headers = {**default_headers, **headers}
-        else:
-            headers = {**default_headers}
-
-        response = self.session.request(method, full_url, headers=headers, params=params, data=data)
+    def _request(self, method, endpoint, paging=False, headers=None, params=None, data=None):
+        full_url = endpoint if paging else self.api_base_url + endpoint
+
+        if LOGGER.isEnabledFor(logging.DEBUG):
+            LOGGER.debug(
+                "Making %s request to endpoint %s, with params %s",
+                method,
+                endpoint if not paging else '@odata.nextLink',
+                params,
+            )
+
+        access_token = self._ensure_access_token()
+
+        response = self.session.request(method, full_url,
+                                        headers=self._build_headers(access_token, headers),
+                                        params=params, data=data)
+
+        if response.status_code == 401:
+            # token was revoked server-side, force a single refresh and retry
+            LOGGER.info("Access token rejected, refreshing and retrying once")
+            self._invalidate_access_token(access_token)
+            access_token = self._ensure_access_token()
+            response = self.session.request(method, full_url,
+                                            headers=self._build_headers(access_token, headers),
+                                            params=params, data=data)
 
         # pylint: disable=no-else-raise
         if response.status_code >= 500:
@@ -177,66 +374,146 @@ class DynamicsClient:
         elif response.status_code >= 400:
             raise Dynamics4xxException(response.text)
 
+        return response
+
+    @staticmethod
+    def _build_headers(access_token, headers=None):
+        """
+        Returns the headers of a Web API request, `headers` only holds
+        overrides. The session only carries the headers that are also safe
+        to send to the token endpoint.
+        """
+        request_headers = dict(ODATA_HEADERS)
+        request_headers["Authorization"] = "Bearer {}".format(access_token)
+        if headers:
+            request_headers.update(headers)
+        return request_headers
+
+    def _make_request(self, method, endpoint, paging=False, headers=None, params=None, data=None):
+        response = self._request(method, endpoint, paging, headers=headers, params=params, data=data)
+
         try:
-            results = response.json()
-        except JSONDecodeError:
-            results = response.text
+            results = orjson.loads(response.content)
+        except orjson.JSONDecodeError:
+            # non-JSON bodies (the `$metadata` XML) are left as bytes, decoding
+            # them to text would run charset detection over the whole body
+            results = response.content
 
         return results
 
     def get(self, endpoint, paging=False, headers=None, params=None):
         return self._make_request("GET", endpoint, paging, headers=headers, params=params)
 
-    def call_entity_definitions(self):
+    def paged_get(self, endpoint, headers=None, params=None):
+        '''
+        Yields each page of `endpoint`, following `@odata.nextLink`. Once a
+            page has arrived, the request for the next one is sent from a
+            single background worker while the caller processes the current
+            page, so at most one HTTP request is in flight at a time.
+        '''
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            future = executor.submit(self.get, endpoint, headers=headers, params=params)
+
+            while future:
+                response = future.result()
+
+                next_link = response.get('@odata.nextLink')
+                if next_link:
+                    future = executor.submit(self.get, next_link, True, headers=headers)
+                else:
+                    future = None
+
+                yield response
+
+    def call_entity_definitions(self) -> list:
         '''
         Calls the `EntityDefinitions` endpoint to get all entities.
         '''
 
         params = {
             "$select": "MetadataId,LogicalName,EntitySetName",
-            "$count": "true",
         }
 
         results = self.get('EntityDefinitions', params=params)
+        entities = results.get('value')
 
-        LOGGER.info('MS Dynamics returned {} entities'.format(results.get("@odata.count")))
+        # counted client-side, `$count` makes the server do the work
+        LOGGER.info('MS Dynamics returned {} entities'.format(len(entities)))
 
-        # return results
-        yield from results.get('value')
+        return entities
 
     def call_metadata(self) -> dict:
         '''
         Calls the `$metadata` endpoint to get entities, key field,
             properties, and corresponding datatypes.
         '''
-        metadata = self.get('$metadata')
+        cache = self._read_metadata_cache()
+        headers = {'If-None-Match': cache['etag']} if cache else None
+
+        response = self._request('GET', '$metadata', headers=headers)
+
+        if response.status_code == 304:
+            LOGGER.info('$metadata is unchanged, using cached entities')
+            return cache['metadata']
+
+        entity_metadata = transform_metadata_xml(response.content)
 
-        return transform_metadata_xml(metadata)
+        etag = response.headers.get('ETag')
+        if etag:
+            self._write_metadata_cache(etag, entity_metadata)
+
+        return entity_metadata
 
     def build_entity_metadata(self):
         '''
         Builds entity metadata from the `EntityDefinitions` and `$metadata` endpoints.
         '''
-        entity_definitions = self.call_entity_definitions()
+        # the two requests are independent, so overlap them
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            entity_definitions = executor.submit(self.call_entity_definitions)
+            entity_metadata = executor.submit(self.call_metadata)
 
-        entity_metadata = self.call_metadata()
+            entity_definitions = entity_definitions.result()
+            entity_metadata = entity_metadata.result()
 
         for entity in entity_definitions:
             entity_name = entity.get("LogicalName")
-            if entity_name in entity_metadata:
-                # checks that entity is in $metadata response
-                entity_metadata[entity_name]["LogicalName"] = entity_name
-                entity_metadata[entity_name]["EntitySetName"] = entity.get("EntitySetName")
-
-        yield from entity_metadata.values()
+            # checks that entity is in $metadata response, popping it so
+            # entities are handed off as soon as they are matched
+            entity_meta = entity_metadata.pop(entity_name, None)
+            if entity_meta is not None:
+                entity_meta["LogicalName"] = entity_name
+                entity_meta["EntitySetName"] = entity.get("EntitySetName")
+                yield entity_meta
 
     @staticmethod
     def build_params(orderby_key: str = 'modifiedon',
                     replication_key: str = 'modifiedon',
-                    filter_value: str = None) -> dict:
-        orderby_param = f'{orderby_key} asc'
+                    filter_value: str = None,
+                    select: list = None) -> dict:
+        params = {"$orderby": f'{orderby_key} asc'}
 
         if filter_value:
-            filter_param = f'{replication_key} ge {filter_value}'
-            return {"$orderby": orderby_param, "$filter": filter_param}
-        return {"$orderby": orderby_param}
+            params["$filter"] = f'{replication_key} ge {filter_value}'
+
+        select = DynamicsClient.build_select(select)
+        if select:
+            params["$select"] = select
+
+        return params
+
+    @staticmethod
+    def build_select(select: list = None) -> str:
+        """
+        Returns the `$select` value for the fields, or None when all columns
+        must be requested because the list would make the URL too long.
+        """
+        if not select:
+            return None
+
+        select = ','.join(select)
+        if len(select) > MAX_SELECT_LENGTH:
+            LOGGER.warning('$select is %d characters long, requesting all columns instead', len(select))
+            return None
+
+        return select
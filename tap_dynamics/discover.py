@@ -1,17 +1,9 @@
-import os
-
-import singer
 from singer import metadata
 from singer.catalog import Catalog
 
+from tap_dynamics.logger import LOGGER
 from tap_dynamics.streams import get_streams
 
-LOGGER = singer.get_logger()
-
-
-def get_abs_path(path):
-    return os.path.join(os.path.dirname(os.path.realpath(__file__)), path)
-
 def _get_key_properties_from_meta(schema_meta):
     return schema_meta[0].get('metadata').get('table-key-properties')
 
@@ -0,0 +1,5 @@
+import singer
+
+# singer.get_logger() re-reads the logging config on every call, so it is
+# called once here and shared by the tap's modules
+LOGGER = singer.get_logger()
@@ -2,9 +2,10 @@ import singer
 from singer import Transformer, metrics
 
 from tap_dynamics.client import DynamicsClient
-from tap_dynamics.transform import (flatten_entity_attributes, get_client_args)
-
-LOGGER = singer.get_logger()
+from tap_dynamics.logger import LOGGER
+from tap_dynamics.transform import (compile_record_transformer,
+                                    flatten_entity_attributes, get_client_args,
+                                    get_selected_fields)
 
 MAX_PAGESIZE = 5000
 
@@ -36,33 +37,28 @@ EXCLUDED_ENTITIES = set([
     'msdyn_knowledgearticlesuggestion'
 ])
 
-STRING_TYPES = set([
-    'Edm.String',
-    'Edm.Guid',
-    ])
-
-INTEGER_TYPES = set([
-    'Edm.Int32',
-    'Edm.Int64',
-])
-
-NUMBER_TYPES = set([
-    'Edm.Decimal',
-    'Edm.Double',
-    ])
-
-DATE_TYPES = set([
-    'Edm.DateTimeOffset',
-    'Edm.Date',
-    ])
-
-BOOL_TYPES = set(['Edm.Boolean'])
-
 COMPLEX_TYPES = set([
     'Edm.Binary',
     'mscrm.BooleanManagedProperty',
     ])
 
+# maps Edm types to (JSON schema type, format), or None when the attribute
+# is skipped; anything not listed is a string
+DEFAULT_TYPE = ('string', None)
+
+TYPE_MAP = {
+    'Edm.String': ('string', None),
+    'Edm.Guid': ('string', None),
+    'Edm.Int32': ('integer', None),
+    'Edm.Int64': ('integer', None),
+    'Edm.Decimal': ('number', None),
+    'Edm.Double': ('number', None),
+    'Edm.DateTimeOffset': ('string', 'date-time'),
+    'Edm.Date': ('string', 'date-time'),
+    'Edm.Boolean': ('boolean', None),
+}
+TYPE_MAP.update({dyn_type: None for dyn_type in COMPLEX_TYPES})
+
 class BaseStream:
     """
     A base class representing singer streams.
@@ -75,6 +71,10 @@ class BaseStream:
     replication_key = None
     key_properties = []
     valid_replication_keys = []
+    # the schema built from the live entity metadata
+    schema = None
+    # only these columns are requested, the fields selected in the catalog
+    select_fields = []
     params = {}
 
     def __init__(self, client: DynamicsClient):
@@ -91,6 +91,36 @@ class BaseStream:
         """
         raise NotImplementedError("Child classes of BaseStream require implementation")
 
+    @staticmethod
+    def get_record_transform(stream_schema: dict, stream_metadata: dict, transformer: Transformer):
+        """
+        Returns the function used to transform each record of the stream.
+
+        :param stream_schema: A dictionary containing the stream schema
+        :param stream_metadata: A dictionnary containing stream metadata
+        :param transformer: A singer Transformer object, used when the schema
+            can't be compiled
+        :return: A function taking a record and returning the transformed record
+        """
+        transform_record = compile_record_transformer(stream_schema, stream_metadata)
+        if transform_record is None:
+            return lambda record: transformer.transform(record, stream_schema, stream_metadata)
+        return transform_record
+
+    def get_select_fields(self, stream_schema: dict, stream_metadata: dict) -> list:
+        """
+        Returns the columns to request, the fields selected in the catalog
+        that the entity still has. A saved catalog can list deleted columns,
+        and naming one in `$select` fails the request.
+
+        :param stream_schema: A dictionary containing the stream schema
+        :param stream_metadata: A dictionnary containing stream metadata
+        :return: The list of field names
+        """
+        entity_fields = self.schema.get('properties', {}) if self.schema else {}
+        return [field_name for field_name in get_selected_fields(stream_schema, stream_metadata)
+                if field_name in entity_fields]
+
     def set_parameters(self, params: dict) -> None:
         """
         Sets or updates the `params` attribute of a class.
@@ -117,22 +147,10 @@ class IncrementalStream(BaseStream):
         pagesize = max_pagesize if max_pagesize <= MAX_PAGESIZE else MAX_PAGESIZE
         header = {'Prefer': f'odata.maxpagesize={pagesize}'}
 
-        params = self.client.build_params(filter_value=bookmark_datetime)
+        params = self.client.build_params(filter_value=bookmark_datetime, select=self.select_fields)
         self.set_parameters(params)
 
-        next_page = True
-        paging = False
-
-        while next_page:
-            response = self.client.get(endpoint, paging, headers=header, params=self.params)
-
-            if '@odata.nextLink' in response:
-                paging = True
-                endpoint = response.get('@odata.nextLink')
-                self.set_parameters({})
-            else:
-                next_page = False
-
+        for response in self.client.paged_get(endpoint, headers=header, params=self.params):
             yield from response.get('value')
 
 
@@ -152,19 +170,33 @@ class IncrementalStream(BaseStream):
                                         self.replication_key,
                                         config['start_date'])
         max_record_value = start_time
+        # compare parsed datetimes, only formatting the bookmark once at the end
+        start_datetime = max_record_datetime = singer.utils.strptime_to_utc(start_time)
+
+        # only download the columns that will be emitted
+        self.select_fields = self.get_select_fields(stream_schema, stream_metadata)
+        transform_record = self.get_record_transform(stream_schema, stream_metadata, transformer)
 
-        with metrics.record_counter(self.tap_stream_id) as counter:
+        # bound once, the loop runs for every record of the stream
+        tap_stream_id = self.tap_stream_id
+        replication_key = self.replication_key
+        strptime_to_utc = singer.utils.strptime_to_utc
+        write_record = singer.write_record
+
+        with metrics.record_counter(tap_stream_id) as counter:
+            increment = counter.increment
             for record in self.get_records(config.get('max_pagesize'), max_record_value):
-                transformed_record = transformer.transform(record, stream_schema, stream_metadata)
-                record_replication_value = singer.utils.strptime_to_utc(transformed_record[self.replication_key])
-                if record_replication_value >= singer.utils.strptime_to_utc(max_record_value):
-                    singer.write_record(self.tap_stream_id, transformed_record)
-                    counter.increment()
-                    max_record_value = record_replication_value.isoformat()
-
-        state = singer.write_bookmark(state, self.tap_stream_id, self.replication_key, max_record_value)
-        singer.write_state(state)
-        return state
+                transformed_record = transform_record(record)
+                record_replication_value = strptime_to_utc(transformed_record[replication_key])
+                if record_replication_value >= max_record_datetime:
+                    write_record(tap_stream_id, transformed_record)
+                    increment()
+                    max_record_datetime = record_replication_value
+
+        if max_record_datetime != start_datetime:
+            max_record_value = max_record_datetime.isoformat()
+
+        return singer.write_bookmark(state, self.tap_stream_id, self.replication_key, max_record_value)
 
 
 class FullTableStream(BaseStream):
@@ -184,22 +216,13 @@ class FullTableStream(BaseStream):
         pagesize = max_pagesize if max_pagesize <= MAX_PAGESIZE else MAX_PAGESIZE
         header = {'Prefer': f'odata.maxpagesize={pagesize}'}
 
-        next_page = True
-        paging = False
-
-        while next_page:
-            response = self.client.get(endpoint, paging, headers=header, params=self.params)
+        select = self.client.build_select(self.select_fields)
+        self.set_parameters({'$select': select} if select else {})
 
+        for response in self.client.paged_get(endpoint, headers=header, params=self.params):
             if not response.get('value'):
                 LOGGER.warning('response is empty for {}'.format(self.stream_endpoint))
 
-            if '@odata.nextLink' in response:
-                paging = True
-                endpoint = response.get('@odata.nextLink')
-                self.set_parameters({})
-            else:
-                next_page = False
-
             yield from response.get('value')
 
 
@@ -214,13 +237,19 @@ class FullTableStream(BaseStream):
         :param transformer: A singer Transformer object
         :return: State data in the form of a dictionary
         """
-        with metrics.record_counter(self.tap_stream_id) as counter:
+        # only download the columns that will be emitted
+        self.select_fields = self.get_select_fields(stream_schema, stream_metadata)
+        transform_record = self.get_record_transform(stream_schema, stream_metadata, transformer)
+
+        tap_stream_id = self.tap_stream_id
+        write_record = singer.write_record
+
+        with metrics.record_counter(tap_stream_id) as counter:
+            increment = counter.increment
             for record in self.get_records(config.get('max_pagesize')):
-                transformed_record = transformer.transform(record, stream_schema, stream_metadata)
-                singer.write_record(self.tap_stream_id, transformed_record)
-                counter.increment()
+                write_record(tap_stream_id, transform_record(record))
+                increment()
 
-        singer.write_state(state)
         return state
 
 
@@ -229,9 +258,19 @@ REPLICATION_TO_STREAM_MAP = {
     'FULL_TABLE': FullTableStream
 }
 
-def get_streams(config: dict, config_path: str) -> dict:
+def get_streams(config: dict, config_path: str, selected: set = None) -> dict:
+    """
+    Returns the streams of the organization.
+
+    :param selected: The tap_stream_ids to build, all streams are built when
+        None
+    """
     STREAMS = {} # pylint: disable=invalid-name
 
+    # nothing selected, nothing to build
+    if selected is not None and not selected:
+        return STREAMS
+
     config["config_path"] = config_path
     client_config = get_client_args(config)
 
@@ -247,9 +286,13 @@ def get_streams(config: dict, config_path: str) -> dict:
         if not stream_name or stream_name in EXCLUDED_ENTITIES:
             continue
 
+        # during sync only the selected streams need a schema
+        if selected is not None and stream_name not in selected:
+            continue
+
         attributes = flatten_entity_attributes(stream.get('Properties'))
 
-        if 'modifiedon' in attributes.keys():
+        if 'modifiedon' in attributes:
             replication_method = 'INCREMENTAL'
             replication_key = 'modifiedon'
         else: replication_method = 'FULL_TABLE'
@@ -275,30 +318,23 @@ def get_streams(config: dict, config_path: str) -> dict:
         if stream_obj.key_properties[0] not in stream_obj.schema.get('properties'):
             continue
 
-        STREAMS.update({stream_name: stream_obj})
+        STREAMS[stream_name] = stream_obj
 
     return STREAMS
 
 def build_schema(attributes: dict):
     json_props = {}
+    get_type_format = TYPE_MAP.get
 
     for attr_name, attr_props in attributes.items():
-        dyn_type = attr_props.get('type')
-        json_type = 'string'
-        json_format = None
-
-        if dyn_type in DATE_TYPES:
-            json_format = 'date-time'
-        elif dyn_type in INTEGER_TYPES:
-            json_type = 'integer'
-        elif dyn_type in NUMBER_TYPES:
-            json_type = 'number'
-        elif dyn_type in BOOL_TYPES:
-            json_type = 'boolean'
-        elif dyn_type in COMPLEX_TYPES:
+        type_format = get_type_format(attr_props.get('type'), DEFAULT_TYPE)
+
+        if type_format is None:
             # TODO: mark as "inclusion": "unsupported"
             continue
 
+        # a new dict per property, schemas are edited in place downstream
+        json_type, json_format = type_format
         prop_json_schema = {
             'type': ['null', json_type]
         }
@@ -1,17 +1,55 @@
+import math
+import sys
+
+import orjson
 import singer
+import singer.messages
 from singer import Transformer, metadata
 
+from tap_dynamics.logger import LOGGER
 from tap_dynamics.streams import get_streams
 
-LOGGER = singer.get_logger()
+_FORMAT_MESSAGE = singer.messages.format_message
+
+def _is_non_finite(value):
+    return value.__class__ is float and not math.isfinite(value)
+
+def encode_message(message) -> bytes:
+    """ Serializes a singer message to a UTF-8 JSON line.
+
+    RECORD messages are encoded with orjson, which differs from singer's
+    encoder in spelling only: non-ASCII text is raw UTF-8 instead of \\u
+    escapes and floats may be written as 1e16 instead of 1e+16. Everything
+    orjson would change in meaning goes through singer's encoder instead:
+    non-finite floats (orjson writes null, singer NaN/Infinity), Decimals and
+    integers wider than 64 bits. Records are flat, so only their top-level
+    values are checked. The other messages are rare and always use singer's
+    encoder. """
+    if message.__class__ is singer.RecordMessage \
+            and not any(map(_is_non_finite, message.record.values())):
+        try:
+            return orjson.dumps(message.asdict())
+        except TypeError:
+            pass
+    return _FORMAT_MESSAGE(message).encode('utf-8')
+
+def write_message(message):
+    """ Writes a singer message to stdout as UTF-8 bytes, whatever the locale
+    encoding. RECORD messages stay in the stdout buffer so they are flushed in
+    blocks rather than one per record """
+    stdout = sys.stdout.buffer
+    stdout.write(encode_message(message) + b'\n')
+    if message.__class__ is not singer.RecordMessage:
+        stdout.flush()
 
 def sync(config, config_path, state, catalog):
     """ Sync data from tap source """
 
-    streams = get_streams(config, config_path)
+    selected = {stream.tap_stream_id for stream in catalog.get_selected_streams(state)}
+    streams = get_streams(config, config_path, selected)
     # TODO: document that newly created fields won't be selected as currently implemented
 
-    LOGGER.info('There are {:d} valid streams in MS Dynamics'.format(len(streams)))
+    LOGGER.info('There are {:d} valid selected streams in MS Dynamics'.format(len(streams)))
 
     with Transformer() as transformer:
         for stream in catalog.get_selected_streams(state):
@@ -1,10 +1,22 @@
+from io import BytesIO
 from xml.etree import ElementTree as ET
 
+from singer import metadata
+from singer.transform import Error, SchemaMismatch, string_to_datetime
+
 NS = {
     "edmx": "http://docs.oasis-open.org/odata/ns/edmx",
     "edm": "http://docs.oasis-open.org/odata/ns/edm"
 }
 
+# Edmx > DataServices > Schema
+SCHEMA_DEPTH = 3
+SCHEMA_TAG = "{%s}Schema" % NS["edm"]
+ENTITY_TYPE_TAG = "{%s}EntityType" % NS["edm"]
+KEY_TAG = "{%s}Key" % NS["edm"]
+PROPERTY_REF_TAG = "{%s}PropertyRef" % NS["edm"]
+PROPERTY_TAG = "{%s}Property" % NS["edm"]
+
 def flatten_entity_attributes(attributes:list) -> dict:
     flat_attributes = {}
 
@@ -12,33 +24,157 @@ def flatten_entity_attributes(attributes:list) -> dict:
         logical_name = attr.get('LogicalName')
         dynamics_type = attr.get('PropertyType')
 
-        flat_attributes.update({logical_name: {'type': dynamics_type}})
+        flat_attributes[logical_name] = {'type': dynamics_type}
 
     return flat_attributes
 
-def transform_metadata_xml(xml:str) -> dict:
-    tree = ET.fromstring(xml)
-
-    data_service = tree.find("edmx:DataServices", NS)
-    entities = data_service.find("edm:Schema", NS)
+def transform_metadata_xml(xml) -> dict:
+    if isinstance(xml, str):
+        xml = xml.encode('utf-8')
 
     entity_def = {}
-    for elem in entities.findall("edm:EntityType", NS):
-        # if an Entity doesn't have elements or a `Key` skip over it
-        if len(elem) and elem.find("edm:Key", NS):
-            entity_key = elem.find("edm:Key", NS).find("edm:PropertyRef", NS).get("Name")
-            entity_name = elem.get("Name")
+    schemas = 0
+    open_elems = []
+    # walk the document incrementally, removing each child of the Schema
+    # once it has been read so the full CSDL tree is never held in memory
+    for event, elem in ET.iterparse(BytesIO(xml), events=("start", "end")):
+        if event == "start":
+            open_elems.append(elem)
+            if len(open_elems) == SCHEMA_DEPTH and elem.tag == SCHEMA_TAG:
+                schemas += 1
+            continue
+
+        open_elems.pop()
+        if len(open_elems) != SCHEMA_DEPTH:
+            continue
+
+        # only the first `Schema` in `DataServices` describes the entities
+        if schemas == 1 and elem.tag == ENTITY_TYPE_TAG:
+            key_elem = elem.find(KEY_TAG)
+            property_ref = key_elem.find(PROPERTY_REF_TAG) if key_elem is not None else None
+
+            # if an Entity doesn't have a `Key` skip over it
+            if property_ref is not None:
+                entity_key = property_ref.get("Name")
+                entity_name = elem.get("Name")
 
-            props = []
-            for prop in elem.findall("edm:Property", NS):
-                prop_name = prop.get("Name")
-                prop_type = prop.get("Type")
-                props.append({"LogicalName": prop_name, "PropertyType": prop_type})
+                props = []
+                for prop in elem.iterfind(PROPERTY_TAG):
+                    prop_name = prop.get("Name")
+                    prop_type = prop.get("Type")
+                    props.append({"LogicalName": prop_name, "PropertyType": prop_type})
 
-            entity_def.update({entity_name: {"Key": entity_key, "Properties": props}})
+                entity_def[entity_name] = {"Key": entity_key, "Properties": props}
+
+        open_elems[-1].remove(elem)
 
     return entity_def
 
+def _to_string(value):
+    if value is None:
+        return None
+    return str(value)
+
+def _to_integer(value):
+    if value is None or value == '':
+        return None
+    if isinstance(value, str):
+        value = value.replace(',', '')
+    return int(value)
+
+def _to_number(value):
+    if value is None or value == '':
+        return None
+    if isinstance(value, str):
+        value = value.replace(',', '')
+    return float(value)
+
+def _to_boolean(value):
+    # matches singer's Transformer, which tries `boolean` before `null`
+    if isinstance(value, str) and value.lower() == 'false':
+        return False
+    return bool(value)
+
+def _to_datetime(value):
+    if value is None or value == '':
+        return None
+    transformed = string_to_datetime(value)
+    if transformed is None:
+        raise ValueError(value)
+    return transformed
+
+CASTERS = {
+    ('string', None): _to_string,
+    ('string', 'date-time'): _to_datetime,
+    ('integer', None): _to_integer,
+    ('number', None): _to_number,
+    ('boolean', None): _to_boolean,
+}
+
+def _get_caster(prop_schema: dict):
+    json_types = prop_schema.get('type')
+    if not isinstance(json_types, list) or len(json_types) != 2 or 'null' not in json_types:
+        return None
+    if set(prop_schema) - {'type', 'format'}:
+        return None
+
+    json_type = json_types[0] if json_types[1] == 'null' else json_types[1]
+    return CASTERS.get((json_type, prop_schema.get('format')))
+
+def is_selected_field(stream_metadata: dict, field_name: str) -> bool:
+    """
+    Returns whether a field is emitted, following singer's Transformer: automatic
+    fields always are, others unless deselected or unsupported.
+    """
+    breadcrumb = ('properties', field_name)
+    inclusion = metadata.get(stream_metadata, breadcrumb, 'inclusion')
+    selected = metadata.get(stream_metadata, breadcrumb, 'selected')
+    return inclusion == 'automatic' or (selected is not False and inclusion != 'unsupported')
+
+def get_selected_fields(schema: dict, stream_metadata: dict) -> list:
+    """
+    Returns the names of the schema properties selected in the stream metadata.
+    """
+    return [field_name for field_name in schema.get('properties', {})
+            if is_selected_field(stream_metadata, field_name)]
+
+def compile_record_transformer(schema: dict, stream_metadata: dict):
+    """
+    Compiles the schema and metadata of a stream into a function that
+    transforms a record the same way singer's `Transformer.transform` does,
+    without walking the schema and metadata for every record.
+
+    :param schema: The stream schema
+    :param stream_metadata: The stream metadata as a map
+    :return: The transform function, or None if the schema isn't flat
+        nullable primitives and the Transformer has to be used
+    """
+    casters = {}
+    for field_name, prop_schema in schema.get('properties', {}).items():
+        caster = _get_caster(prop_schema)
+        if caster is None:
+            return None
+
+        if not is_selected_field(stream_metadata, field_name):
+            continue
+
+        casters[field_name] = caster
+
+    def transform_record(record: dict) -> dict:
+        transformed_record = {}
+        for field_name, value in record.items():
+            caster = casters.get(field_name)
+            if caster is None:
+                continue
+            try:
+                transformed_record[field_name] = caster(value)
+            except (TypeError, ValueError) as ex:
+                error = Error([field_name], value, schema['properties'][field_name])
+                raise SchemaMismatch([error]) from ex
+        return transformed_record
+
+    return transform_record
+
 def get_client_args(config):
     return {
         "organization_uri": config.get('organization_uri'),
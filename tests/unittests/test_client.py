@@ -0,0 +1,288 @@
+import json
+import stat
+import threading
+import time
+from datetime import timedelta
+from unittest import mock
+
+import pytest
+import singer
+
+from tap_dynamics.client import DynamicsClient, Dynamics4xxException
+
+
+def get_client(config_path='config.json', **kwargs):
+    return DynamicsClient(organization_uri='https://org.crm.dynamics.com',
+                          config_path=config_path,
+                          max_pagesize=None,
+                          user_agent='tap-dynamics <test@example.com>',
+                          refresh_token='refresh_token',
+                          **kwargs)
+
+def write_config(tmp_path, config):
+    config_path = tmp_path / 'config.json'
+    config_path.write_text(json.dumps(config))
+    return config_path
+
+def get_token_response():
+    response = mock.Mock(status_code=200)
+    response.json.return_value = {
+        'access_token': 'access_token',
+        'refresh_token': 'refresh_token',
+        'expires_in': '3600',
+    }
+    return response
+
+def test_ensure_access_token_refreshes_once(tmp_path):
+    client = get_client(str(write_config(tmp_path, {'refresh_token': 'refresh_token'})))
+    client.session.post = mock.Mock(return_value=get_token_response())
+
+    threads = [threading.Thread(target=client._ensure_access_token) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert client.session.post.call_count == 1
+    assert client.access_token == 'access_token'
+
+def test_paged_get_follows_next_link():
+    client = get_client()
+    client.get = mock.Mock(side_effect=[
+        {'value': [{'id': 1}], '@odata.nextLink': 'https://org/next'},
+        {'value': [{'id': 2}]},
+    ])
+
+    pages = list(client.paged_get('accounts', params={'$orderby': 'modifiedon asc'}))
+
+    assert [page['value'] for page in pages] == [[{'id': 1}], [{'id': 2}]]
+    assert client.get.call_args_list == [
+        mock.call('accounts', headers=None, params={'$orderby': 'modifiedon asc'}),
+        mock.call('https://org/next', True, headers=None),
+    ]
+
+def test_429_honors_retry_after():
+    client = get_client()
+    client.access_token = 'access_token'
+    client.expires_at = time.monotonic() + 3600
+    throttled = mock.Mock(status_code=429, headers={'Retry-After': '3'})
+    ok = mock.Mock(status_code=200, content=b'{"value": []}')
+    client.session.request = mock.Mock(side_effect=[throttled, ok])
+
+    with mock.patch('time.sleep') as sleep:
+        assert client.get('accounts') == {'value': []}
+
+    sleep.assert_called_once_with(3)
+
+def test_odata_headers_are_sent_to_the_web_api_only(tmp_path):
+    client = get_client(str(write_config(tmp_path, {'refresh_token': 'refresh_token'})))
+    client.session.post = mock.Mock(return_value=get_token_response())
+    client.session.request = mock.Mock(return_value=mock.Mock(status_code=200, content=b'{}'))
+
+    client.get('accounts', headers={'Prefer': 'odata.maxpagesize=10'})
+
+    assert 'OData-Version' not in client.session.headers
+    assert 'Authorization' not in client.session.headers
+    assert 'headers' not in client.session.post.call_args.kwargs
+    assert client.session.request.call_args.kwargs['headers'] == {
+        'OData-MaxVersion': '4.0',
+        'OData-Version': '4.0',
+        'If-None-Match': 'null',
+        'Authorization': 'Bearer access_token',
+        'Prefer': 'odata.maxpagesize=10',
+    }
+
+def test_build_entity_metadata_yields_matched_entities():
+    client = get_client()
+    client.call_entity_definitions = mock.Mock(return_value=[
+        {'LogicalName': 'account', 'EntitySetName': 'accounts'},
+        {'LogicalName': 'missing', 'EntitySetName': 'missings'},
+    ])
+    client.call_metadata = mock.Mock(return_value={
+        'account': {'Key': 'accountid', 'Properties': []},
+        'contact': {'Key': 'contactid', 'Properties': []},
+    })
+
+    result = list(client.build_entity_metadata())
+
+    assert result == [{'Key': 'accountid', 'Properties': [],
+                       'LogicalName': 'account', 'EntitySetName': 'accounts'}]
+
+def test_write_config_persists_refresh_token(tmp_path):
+    config_path = write_config(tmp_path, {'refresh_token': 'old', 'client_id': 'client_id'})
+    client = get_client(str(config_path))
+
+    client._write_config('new')
+
+    assert json.loads(config_path.read_text()) == {
+        'refresh_token': 'new',
+        'client_id': 'client_id',
+    }
+    assert client.refresh_token == 'new'
+    assert list(tmp_path.iterdir()) == [config_path]
+
+def test_write_config_keeps_file_mode(tmp_path):
+    config_path = write_config(tmp_path, {'refresh_token': 'old'})
+    config_path.chmod(0o600)
+    client = get_client(str(config_path))
+
+    client._write_config('new')
+
+    assert stat.S_IMODE(config_path.stat().st_mode) == 0o600
+
+def test_write_config_removes_temp_file_on_failure(tmp_path):
+    config_path = write_config(tmp_path, {'refresh_token': 'old'})
+    client = get_client(str(config_path))
+
+    with mock.patch('os.replace', side_effect=OSError), pytest.raises(OSError):
+        client._write_config('new')
+
+    assert list(tmp_path.iterdir()) == [config_path]
+    assert json.loads(config_path.read_text()) == {'refresh_token': 'old'}
+
+def test_refresh_caches_access_token_outside_config(tmp_path):
+    config_path = write_config(tmp_path, {'refresh_token': 'refresh_token'})
+    client = get_client(str(config_path))
+    client.session.post = mock.Mock(return_value=get_token_response())
+
+    client._ensure_access_token()
+
+    # the refresh_token didn't rotate, the config is left alone
+    assert json.loads(config_path.read_text()) == {'refresh_token': 'refresh_token'}
+    token_cache_path = tmp_path / '.dynamics_token_cache.json'
+    assert stat.S_IMODE(token_cache_path.stat().st_mode) == 0o600
+
+    client = get_client(str(config_path))
+    client.session.post = mock.Mock()
+    client._ensure_access_token()
+
+    client.session.post.assert_not_called()
+    assert client.access_token == 'access_token'
+
+def test_refresh_without_config_path():
+    client = get_client(None)
+    client.session.post = mock.Mock(return_value=mock.Mock(status_code=200, json=mock.Mock(return_value={
+        'access_token': 'access_token', 'refresh_token': 'rotated', 'expires_in': '3600'})))
+
+    client._ensure_access_token()
+
+    assert client.access_token == 'access_token'
+    assert client.refresh_token == 'rotated'
+
+def write_token_cache(tmp_path, expires_at, organization_uri='https://org.crm.dynamics.com'):
+    (tmp_path / '.dynamics_token_cache.json').write_text(json.dumps({
+        'organization_uri': organization_uri, 'client_id': None,
+        'access_token': 'cached', 'expires_at': expires_at.isoformat()}))
+    return str(write_config(tmp_path, {}))
+
+def test_ignores_expired_cached_access_token(tmp_path):
+    config_path = write_token_cache(tmp_path, singer.utils.now() - timedelta(minutes=1))
+
+    assert get_client(config_path).access_token is None
+
+def test_ignores_cached_access_token_of_other_org(tmp_path):
+    config_path = write_token_cache(tmp_path, singer.utils.now() + timedelta(hours=1),
+                                    organization_uri='https://other.crm.dynamics.com')
+
+    assert get_client(config_path).access_token is None
+
+def test_401_refreshes_token_and_retries_once(tmp_path):
+    client = get_client(str(write_config(tmp_path, {'refresh_token': 'refresh_token'})))
+    client.access_token = 'revoked'
+    client.expires_at = time.monotonic() + 3600
+    client.session.post = mock.Mock(return_value=get_token_response())
+    unauthorized = mock.Mock(status_code=401)
+    ok = mock.Mock(status_code=200, content=b'{"value": []}')
+    client.session.request = mock.Mock(side_effect=[unauthorized, ok])
+
+    assert client.get('accounts') == {'value': []}
+    assert client.session.post.call_count == 1
+    assert client.access_token == 'access_token'
+
+def test_concurrent_401s_refresh_once(tmp_path):
+    client = get_client(str(write_config(tmp_path, {'refresh_token': 'refresh_token'})))
+    client.access_token = 'revoked'
+    client.expires_at = time.monotonic() + 3600
+    client.session.post = mock.Mock(return_value=get_token_response())
+    # both requests are sent with the revoked token before either refreshes
+    barrier = threading.Barrier(2)
+
+    def request(method, url, headers=None, **kwargs):
+        if headers['Authorization'] == 'Bearer revoked':
+            barrier.wait(timeout=5)
+            return mock.Mock(status_code=401)
+        return mock.Mock(status_code=200, content=b'{"value": []}')
+    client.session.request = mock.Mock(side_effect=request)
+
+    threads = [threading.Thread(target=client.get, args=('accounts',)) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert client.session.post.call_count == 1
+    assert client.session.request.call_count == 4
+
+def test_4xx_fails_without_backoff():
+    client = get_client()
+    client.access_token = 'access_token'
+    client.expires_at = time.monotonic() + 3600
+    client.session.request = mock.Mock(return_value=mock.Mock(status_code=403, text='Forbidden'))
+
+    with mock.patch('time.sleep') as sleep, pytest.raises(Dynamics4xxException):
+        client.get('accounts')
+
+    assert client.session.request.call_count == 1
+    sleep.assert_not_called()
+
+METADATA_XML = b'''<?xml version="1.0" encoding="utf-8"?>
+<edmx:Edmx Version="4.0" xmlns:edmx="http://docs.oasis-open.org/odata/ns/edmx">
+    <edmx:DataServices>
+        <Schema Namespace="Microsoft.Dynamics.CRM" Alias="mscrm" xmlns="http://docs.oasis-open.org/odata/ns/edm">
+            <EntityType Name="account">
+                <Key>
+                    <PropertyRef Name="accountid" />
+                </Key>
+                <Property Name="accountid" Type="Edm.Guid" />
+            </EntityType>
+        </Schema>
+    </edmx:DataServices>
+</edmx:Edmx>
+'''
+
+def test_call_metadata_revalidates_cached_metadata(tmp_path):
+    config_path = str(write_config(tmp_path, {}))
+    expected = {'account': {'Key': 'accountid',
+                            'Properties': [{'LogicalName': 'accountid', 'PropertyType': 'Edm.Guid'}]}}
+
+    client = get_client(config_path)
+    client._request = mock.Mock(return_value=mock.Mock(
+        status_code=200, content=METADATA_XML, headers={'ETag': 'W/"1"'}))
+    assert client.call_metadata() == expected
+    client._request.assert_called_once_with('GET', '$metadata', headers=None)
+
+    client = get_client(config_path)
+    client._request = mock.Mock(return_value=mock.Mock(status_code=304))
+    assert client.call_metadata() == expected
+    client._request.assert_called_once_with('GET', '$metadata', headers={'If-None-Match': 'W/"1"'})
+
+def test_call_metadata_ignores_old_cache_format(tmp_path):
+    config_path = str(write_config(tmp_path, {}))
+    (tmp_path / '.dynamics_metadata_cache.json').write_text(json.dumps({
+        'organization_uri': 'https://org.crm.dynamics.com', 'api_version': '9.2',
+        'etag': 'W/"1"', 'metadata': {}}))
+
+    client = get_client(config_path)
+    client._request = mock.Mock(return_value=mock.Mock(
+        status_code=200, content=METADATA_XML, headers={'ETag': 'W/"1"'}))
+    client.call_metadata()
+
+    client._request.assert_called_once_with('GET', '$metadata', headers=None)
+
+def test_call_metadata_survives_cache_write_failure(tmp_path):
+    client = get_client(str(write_config(tmp_path, {})))
+    client._request = mock.Mock(return_value=mock.Mock(
+        status_code=200, content=METADATA_XML, headers={'ETag': 'W/"1"'}))
+
+    with mock.patch('tap_dynamics.client.write_file_atomic', side_effect=PermissionError):
+        assert list(client.call_metadata()) == ['account']
@@ -0,0 +1,156 @@
+from unittest import mock
+
+from singer import Transformer, metadata
+
+from tap_dynamics.client import DynamicsClient
+from tap_dynamics.streams import (FullTableStream, IncrementalStream, build_schema,
+                                  get_streams)
+
+def test_build_schema():
+    attributes = {
+        'accountid': {'type': 'Edm.Guid'},
+        'name': {'type': 'Edm.String'},
+        'numberofemployees': {'type': 'Edm.Int32'},
+        'revenue': {'type': 'Edm.Decimal'},
+        'donotphone': {'type': 'Edm.Boolean'},
+        'modifiedon': {'type': 'Edm.DateTimeOffset'},
+        'entityimage': {'type': 'Edm.Binary'},
+        'iscustomizable': {'type': 'mscrm.BooleanManagedProperty'},
+        'unknown': {'type': 'Edm.Unknown'},
+    }
+
+    expected = {
+        'type': 'object',
+        'additionalProperties': False,
+        'properties': {
+            'accountid': {'type': ['null', 'string']},
+            'name': {'type': ['null', 'string']},
+            'numberofemployees': {'type': ['null', 'integer']},
+            'revenue': {'type': ['null', 'number']},
+            'donotphone': {'type': ['null', 'boolean']},
+            'modifiedon': {'type': ['null', 'string'], 'format': 'date-time'},
+            'unknown': {'type': ['null', 'string']},
+        }
+    }
+
+    assert expected == build_schema(attributes)
+
+def test_build_schema_properties_are_independent():
+    schema = build_schema({'accountid': {'type': 'Edm.Guid'}, 'name': {'type': 'Edm.String'}})
+
+    schema['properties']['accountid']['type'].remove('null')
+
+    assert build_schema({'name': {'type': 'Edm.String'}})['properties']['name'] == {'type': ['null', 'string']}
+    assert schema['properties']['name'] == {'type': ['null', 'string']}
+
+def get_incremental_stream(pages):
+    client = mock.Mock()
+    client.build_params = DynamicsClient.build_params
+    client.paged_get.return_value = iter(pages)
+
+    stream = IncrementalStream(client)
+    stream.tap_stream_id = 'account'
+    stream.stream_endpoint = 'accounts'
+    stream.key_properties = ['accountid']
+    stream.replication_key = 'modifiedon'
+    stream.schema = build_schema({'accountid': {'type': 'Edm.Guid'},
+                                  'modifiedon': {'type': 'Edm.DateTimeOffset'}})
+    return stream
+
+@mock.patch('singer.write_record')
+def test_incremental_sync_bookmarks_max_replication_value(write_record):
+    stream = get_incremental_stream([
+        {'value': [{'accountid': '1', 'modifiedon': '2021-07-01T00:00:00Z'},
+                   {'accountid': '2', 'modifiedon': '2021-06-01T00:00:00Z'}]},
+        {'value': [{'accountid': '3', 'modifiedon': '2021-08-01T00:00:00Z'}]},
+    ])
+    config = {'start_date': '2021-06-15T00:00:00Z'}
+
+    with Transformer() as transformer:
+        state = stream.sync({}, stream.schema, metadata.to_map([]), config, transformer)
+
+    assert [call.args[1]['accountid'] for call in write_record.call_args_list] == ['1', '3']
+    assert state == {'bookmarks': {'account': {'modifiedon': '2021-08-01T00:00:00+00:00'}}}
+    stream.client.paged_get.assert_called_once_with(
+        'accounts',
+        headers={'Prefer': 'odata.maxpagesize=5000'},
+        params={'$orderby': 'modifiedon asc',
+                '$filter': 'modifiedon ge 2021-06-15T00:00:00Z',
+                '$select': 'accountid,modifiedon'})
+
+@mock.patch('singer.write_record')
+def test_incremental_sync_keeps_bookmark_without_records(write_record):
+    stream = get_incremental_stream([{'value': []}])
+    config = {'start_date': '2021-06-15T00:00:00Z'}
+
+    with Transformer() as transformer:
+        state = stream.sync({}, stream.schema, metadata.to_map([]), config, transformer)
+
+    write_record.assert_not_called()
+    assert state == {'bookmarks': {'account': {'modifiedon': '2021-06-15T00:00:00Z'}}}
+
+@mock.patch('singer.write_record')
+def test_full_table_sync_selects_catalog_fields(write_record):
+    client = mock.Mock()
+    client.build_select = DynamicsClient.build_select
+    client.paged_get.return_value = iter([{'value': [{'accountid': '1', 'name': 'Fourth Coffee'}]}])
+
+    stream = FullTableStream(client)
+    stream.tap_stream_id = 'account'
+    stream.stream_endpoint = 'accounts'
+    stream.key_properties = ['accountid']
+    stream.schema = build_schema({'accountid': {'type': 'Edm.Guid'},
+                                  'name': {'type': 'Edm.String'},
+                                  'description': {'type': 'Edm.String'}})
+    schema = stream.schema
+    mdata = metadata.to_map(metadata.get_standard_metadata(schema=schema, key_properties=['accountid']))
+    mdata = metadata.write(mdata, ('properties', 'description'), 'selected', False)
+
+    with Transformer() as transformer:
+        stream.sync({}, schema, mdata, {}, transformer)
+
+    write_record.assert_called_once_with('account', {'accountid': '1', 'name': 'Fourth Coffee'})
+    client.paged_get.assert_called_once_with(
+        'accounts',
+        headers={'Prefer': 'odata.maxpagesize=5000'},
+        params={'$select': 'accountid,name'})
+
+@mock.patch('singer.write_record')
+def test_incremental_sync_skips_deleted_catalog_fields(write_record):
+    stream = get_incremental_stream([{'value': []}])
+    # the saved catalog still has a column deleted from the entity since
+    catalog_schema = build_schema({'accountid': {'type': 'Edm.Guid'},
+                                   'modifiedon': {'type': 'Edm.DateTimeOffset'},
+                                   'new_deletedcolumn': {'type': 'Edm.String'}})
+    config = {'start_date': '2021-06-15T00:00:00Z'}
+
+    with Transformer() as transformer:
+        stream.sync({}, catalog_schema, metadata.to_map([]), config, transformer)
+
+    assert stream.client.paged_get.call_args.kwargs['params']['$select'] == 'accountid,modifiedon'
+
+def test_build_params_drops_long_select():
+    select = ['new_customfield{:04d}'.format(index) for index in range(1000)]
+
+    assert DynamicsClient.build_params(select=select) == {'$orderby': 'modifiedon asc'}
+    assert DynamicsClient.build_params(select=select[:10])['$select'] == ','.join(select[:10])
+
+@mock.patch('tap_dynamics.streams.DynamicsClient')
+def test_get_streams_builds_only_selected_streams(client_class):
+    client_class.return_value.build_entity_metadata.return_value = [
+        {'LogicalName': 'account', 'EntitySetName': 'accounts', 'Key': 'accountid',
+         'Properties': [{'LogicalName': 'accountid', 'PropertyType': 'Edm.Guid'}]},
+        {'LogicalName': 'contact', 'EntitySetName': 'contacts', 'Key': 'contactid',
+         'Properties': [{'LogicalName': 'contactid', 'PropertyType': 'Edm.Guid'}]},
+    ]
+    config = {'organization_uri': 'https://org.crm.dynamics.com', 'client_id': 'client_id'}
+
+    assert list(get_streams(config, 'config.json', {'contact'})) == ['contact']
+    assert list(get_streams(config, 'config.json')) == ['account', 'contact']
+
+@mock.patch('tap_dynamics.streams.DynamicsClient')
+def test_get_streams_builds_nothing_without_selection(client_class):
+    config = {'organization_uri': 'https://org.crm.dynamics.com', 'client_id': 'client_id'}
+
+    assert get_streams(config, 'config.json', set()) == {}
+    client_class.assert_not_called()
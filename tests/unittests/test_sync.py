@@ -0,0 +1,99 @@
+import copy
+import decimal
+import json
+import math
+from unittest import mock
+
+import pytest
+import singer
+
+import tap_dynamics
+from tap_dynamics.sync import encode_message, sync, write_message
+
+def test_encode_message_matches_singer():
+    message = singer.RecordMessage(stream='account', record={
+        'accountid': '1', 'name': 'Caf\u00e9 \u6771\u4eac', 'revenue': 1e16, 'donotphone': None})
+
+    encoded = encode_message(message)
+
+    assert encoded.decode('utf-8') != singer.format_message(message)
+    assert json.loads(encoded) == json.loads(singer.format_message(message))
+
+def test_encode_message_falls_back_for_decimal_and_nan():
+    messages = [
+        singer.RecordMessage(stream='account', record={'revenue': decimal.Decimal('1.10')}),
+        singer.RecordMessage(stream='account', record={'revenue': math.nan, 'name': 'Caf\u00e9'}),
+        singer.RecordMessage(stream='account', record={'revenue': -math.inf}),
+        singer.StateMessage(value={'bookmarks': {'account': {'revenue': decimal.Decimal('1.10')}}}),
+    ]
+
+    for message in messages:
+        assert encode_message(message) == singer.format_message(message).encode('utf-8')
+
+def test_write_message_flushes_on_state_only():
+    with mock.patch('sys.stdout') as stdout:
+        write_message(singer.RecordMessage(stream='account', record={'accountid': '1'}))
+        stdout.buffer.flush.assert_not_called()
+
+        write_message(singer.StateMessage(value={'bookmarks': {}}))
+        stdout.buffer.flush.assert_called_once_with()
+
+    stdout.write.assert_not_called()
+    assert [json.loads(call.args[0]) for call in stdout.buffer.write.call_args_list] == [
+        {'type': 'RECORD', 'stream': 'account', 'record': {'accountid': '1'}},
+        {'type': 'STATE', 'value': {'bookmarks': {}}},
+    ]
+
+def get_catalog(*stream_names):
+    schema = {'type': 'object', 'properties': {'accountid': {'type': ['null', 'string']}}}
+    return singer.Catalog.from_dict({'streams': [
+        {'tap_stream_id': name, 'stream': name, 'schema': schema,
+         'metadata': [{'breadcrumb': [], 'metadata': {'selected': True}}]}
+        for name in stream_names
+    ]})
+
+def get_stream(bookmark):
+    def stream_sync(state, *args):
+        return singer.write_bookmark(state, stream.tap_stream_id, 'modifiedon', bookmark)
+    stream = mock.Mock(key_properties=['accountid'])
+    stream.sync.side_effect = stream_sync
+    return stream
+
+@mock.patch('singer.write_schema')
+@mock.patch('singer.write_state')
+@mock.patch('tap_dynamics.sync.get_streams')
+def test_sync_writes_bookmark_after_each_stream(get_streams, write_state, write_schema):
+    # state is updated in place, keep a copy of each message
+    states = []
+    write_state.side_effect = lambda state: states.append(copy.deepcopy(state))
+    account = get_stream('2021-07-01T00:00:00+00:00')
+    account.tap_stream_id = 'account'
+    get_streams.return_value = {'account': account}
+
+    # the second stream fails before it starts, the first bookmark is already out
+    with pytest.raises(KeyError):
+        sync({}, 'config.json', {}, get_catalog('account', 'contact'))
+
+    assert states == [
+        {'currently_syncing': 'account'},
+        {'currently_syncing': 'account',
+         'bookmarks': {'account': {'modifiedon': '2021-07-01T00:00:00+00:00'}}},
+    ]
+
+@mock.patch('singer.messages.write_message')
+@mock.patch('singer.utils.parse_args')
+@mock.patch('tap_dynamics.streams.DynamicsClient')
+def test_main_without_catalog_requests_metadata_once(client_class, parse_args, write_message_):
+    # streams discovered without a catalog aren't selected, sync builds none
+    client_class.return_value.build_entity_metadata.side_effect = lambda: iter([
+        {'LogicalName': 'account', 'EntitySetName': 'accounts', 'Key': 'accountid',
+         'Properties': [{'LogicalName': 'accountid', 'PropertyType': 'Edm.Guid'}]},
+    ])
+    client_class.return_value.paged_get.return_value = iter([{'value': [{'accountid': '1'}]}])
+    parse_args.return_value = mock.Mock(discover=False, catalog=None, state={}, config_path='config.json',
+                                        config={'organization_uri': 'https://org.crm.dynamics.com',
+                                                'start_date': '2021-06-15T00:00:00Z'})
+
+    tap_dynamics.main()
+
+    client_class.return_value.build_entity_metadata.assert_called_once_with()
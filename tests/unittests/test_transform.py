@@ -1,4 +1,11 @@
-from tap_dynamics.transform import (flatten_entity_attributes,
+import copy
+
+import pytest
+from singer import Transformer, metadata
+from singer.transform import SchemaMismatch
+
+from tap_dynamics.transform import (compile_record_transformer,
+                                    flatten_entity_attributes,
                                     transform_metadata_xml)
 
 def test_flatten_entity_attributes():
@@ -88,3 +95,95 @@ def test_transform_metadata_xml():
     result = transform_metadata_xml(xml_string)
 
     assert expected == result
+
+def test_transform_metadata_xml_reads_first_schema():
+    xml_bytes = b'''<?xml version="1.0" encoding="utf-8"?>
+    <edmx:Edmx Version="4.0" xmlns:edmx="http://docs.oasis-open.org/odata/ns/edmx">
+        <edmx:DataServices>
+            <Schema Namespace="Microsoft.Dynamics.CRM" Alias="mscrm" xmlns="http://docs.oasis-open.org/odata/ns/edm">
+                <EntityType Name="account" BaseType="mscrm.crmbaseentity">
+                    <Key>
+                        <PropertyRef Name="accountid" />
+                    </Key>
+                    <Property Name="accountid" Type="Edm.Guid" />
+                </EntityType>
+                <EntityType Name="crmbaseentity" Abstract="true" />
+            </Schema>
+            <Schema Namespace="Other" xmlns="http://docs.oasis-open.org/odata/ns/edm">
+                <EntityType Name="other">
+                    <Key>
+                        <PropertyRef Name="otherid" />
+                    </Key>
+                    <Property Name="otherid" Type="Edm.Guid" />
+                </EntityType>
+            </Schema>
+        </edmx:DataServices>
+    </edmx:Edmx>
+    '''
+    expected = {
+        'account': {
+            'Key': 'accountid',
+            'Properties': [
+                {'LogicalName': 'accountid', 'PropertyType': 'Edm.Guid'},
+            ]
+        }
+    }
+
+    result = transform_metadata_xml(xml_bytes)
+
+    assert expected == result
+
+def test_compile_record_transformer_matches_transformer():
+    schema = {
+        'type': 'object',
+        'additionalProperties': False,
+        'properties': {
+            'accountid': {'type': ['null', 'string']},
+            'name': {'type': ['null', 'string']},
+            'numberofemployees': {'type': ['null', 'integer']},
+            'revenue': {'type': ['null', 'number']},
+            'donotphone': {'type': ['null', 'boolean']},
+            'donotemail': {'type': ['null', 'boolean']},
+            'modifiedon': {'type': ['null', 'string'], 'format': 'date-time'},
+            'createdon': {'type': ['null', 'string'], 'format': 'date-time'},
+            'description': {'type': ['null', 'string']},
+        }
+    }
+    mdata = metadata.to_map(metadata.get_standard_metadata(schema=schema,
+                                                           key_properties=['accountid']))
+    mdata = metadata.write(mdata, ('properties', 'description'), 'selected', False)
+    records = [
+        {
+            '@odata.etag': 'W/"1"',
+            'accountid': '5e0e1a9c-0000-0000-0000-000000000000',
+            'name': 'Fourth Coffee',
+            'numberofemployees': '1,200',
+            'revenue': 1000.5,
+            'donotphone': None,
+            'donotemail': 'false',
+            'modifiedon': '2021-07-01T12:34:56Z',
+            'createdon': None,
+            'description': 'not selected',
+        },
+        {'accountid': 5, 'numberofemployees': '', 'revenue': 10, 'donotphone': True},
+    ]
+
+    transform_record = compile_record_transformer(schema, mdata)
+
+    for record in records:
+        with Transformer() as transformer:
+            expected = transformer.transform(dict(record), copy.deepcopy(schema), mdata)
+        assert expected == transform_record(dict(record))
+
+def test_compile_record_transformer_raises_schema_mismatch():
+    schema = {'type': 'object', 'properties': {'numberofemployees': {'type': ['null', 'integer']}}}
+
+    transform_record = compile_record_transformer(schema, {})
+
+    with pytest.raises(SchemaMismatch):
+        transform_record({'numberofemployees': 'many'})
+
+def test_compile_record_transformer_falls_back_for_nested_schemas():
+    schema = {'type': 'object', 'properties': {'address': {'type': ['null', 'object']}}}
+
+    assert compile_record_transformer(schema, {}) is None